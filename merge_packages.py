@@ -7,9 +7,44 @@ In that case, the result is written to OUTPUT/package.xml. The resuling package
 uses the greatest version number from all included packages, and metadata types
 and members are returned sorted alphabetically
 '''
-from xmltodict import parse, unparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from lxml import etree
+from sortedcontainers import SortedSet
+from xml.sax.saxutils import escape
 import argparse
+import io
 import os
+import pathlib
+import sys
+
+# Namespace used by SFDC package.xml files
+SFDC_NAMESPACE = 'http://soap.sforce.com/2006/04/metadata'
+
+# Namespaced tags looked for when parsing each package.xml file
+TYPES_TAG = f'{{{SFDC_NAMESPACE}}}types'
+MEMBERS_TAG = f'{{{SFDC_NAMESPACE}}}members'
+NAME_TAG = f'{{{SFDC_NAMESPACE}}}name'
+VERSION_TAG = f'{{{SFDC_NAMESPACE}}}version'
+FULLNAME_TAG = f'{{{SFDC_NAMESPACE}}}fullName'
+
+# Minimum number of package files before parsing is spread over a process
+# pool, so small merges don't pay the cost of spinning one up
+MIN_PARALLEL_PACKAGES = 8
+
+# Templates used to build the blocks of the merged package.xml
+PACKAGE_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'\
+    + f'<Package xmlns="{SFDC_NAMESPACE}">\n'\
+    + '    <fullName>Merged_Package</fullName>\n'
+TYPE_TEMPLATE = '    <types>\n'\
+    + '{members}\n'\
+    + '        <name>{name}</name>\n'\
+    + '    </types>\n'
+MEMBER_TEMPLATE = '        <members>{}</members>'
+PACKAGE_FOOTER = '    <version>{version:.1f}</version>\n'\
+    + '    <description>{description}</description>\n'\
+    + '</Package>\n'
 
 def parse_arguments():
     '''
@@ -30,11 +65,15 @@ def parse_arguments():
     parser.add_argument('source',
         help='source directory where to get package.xml files from'
     )
-    parser.add_argument('-o', '--output', 
+    parser.add_argument('-o', '--output',
         help='output directory to write the merged package to. '\
             + 'If not present, package is written to STDOUT.'
     )
-    
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='number of worker processes used to parse package files in '\
+            + 'parallel. Defaults to the number of CPUs.'
+    )
+
     return parser.parse_args()
 
 def validate_paths(args):
@@ -44,142 +83,250 @@ def validate_paths(args):
     written to. Raises an error if either directory is invalid.
     '''
 
-    # Get the absolute path to SOURCE, expanding the ~ hoeme var if necessary
-    sourcepath = os.path.abspath(
-        os.path.expanduser(
-            args.source
-        )
-    )
-
-    # Raise an error if the path to source does not exist, or is a file
-    if (not os.path.exists(sourcepath)) or os.path.isfile(sourcepath):
+    # Resolve the absolute path to SOURCE, expanding the ~ home var if
+    # necessary, then raise an error if it is not an existing directory
+    sourcepath = pathlib.Path(args.source).expanduser().resolve()
+    if not sourcepath.is_dir():
         raise ValueError(f'SOURCE not a valid directory: {sourcepath}')
 
-    # Build the absolute path to OUTPUT, if the -o flag was included
-    outpath = os.path.abspath(
-        os.path.expanduser(
-            args.output
-        )
-    ) if args.output else None
-
-    # Raise an error if the path to OUTPUT does not exist (and is not STDOUT)
-    # of if it exists but points to a file
-    if outpath and (
-        (not os.path.exists(outpath)) or\
-        os.path.isfile(sourcepath)
-    ):
+    # Do the same for OUTPUT, if the -o flag was included (otherwise the
+    # merged package goes to STDOUT)
+    outpath = pathlib.Path(args.output).expanduser().resolve()\
+        if args.output else None
+    if outpath and not outpath.is_dir():
         raise ValueError(f'OUTPUT is not a valid directory: {outpath}')
 
     return sourcepath, outpath
 
-def merge(packages, outpath, verbose):
+def find_packages(root):
     '''
-    Takes all found package.xml files, converts each to a dictionary, then
-    aggregates metadata types and members in a separate dict. At the end,
-    re-writes into a template of an SFDC package, replacing it with the 
-    aggregated metadata. The result is printed to STDOUT or to a file in the 
-    OUTPUT directory
+    Walks the subdirectory tree rooted at root and yields the path of every
+    file named package.xml. Uses os.scandir instead of os.walk, so the type
+    of each entry comes for free from the directory listing, avoiding an
+    extra stat() call per entry on large source trees
     '''
 
-    if verbose: print('\n//// MERGING PACKAGES\n')
+    stack = [root] # Initialize the stack of directories left to scan
+
+    while stack:
+        directory = stack.pop()
+        # Skip directories that can't be listed (e.g. for lack of
+        # permissions), like os.walk silently did before
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                # Queue subdirectories to be scanned in turn, but don't
+                # follow symlinks so the walk can't loop back on itself
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name == 'package.xml' and entry.is_file():
+                    yield entry.path
+
+def parse_package(filepath):
+    '''
+    Streams one package.xml file through lxml's iterparse, visiting each
+    element as its closing tag is read so no full document tree is ever
+    built. Returns a (package name, version, types) tuple, where types is a
+    list of (metadata type name, members) pairs, and name and version are
+    None if not found in the file
+    '''
 
-    types_dict = {} # Initialize the dictionary of metadata types
-    package_names = [] # Initialize the list of package names
-    max_version = None # Initialize the max version number
-    template = None # Initialize the package template to use as format
+    package_name = None # The fullName found in this file
+    version = None # The version found in this file
+    file_types = [] # The (name, members) pairs found in this file
+
+    with open(filepath, 'rb') as file:
+        # Cheaply reject files that can't be SFDC packages by looking for
+        # the Package tag in the first 4KB, before paying the cost of
+        # parsing them
+        head = file.read(4096)
+        if b'<Package' not in head:
+            return package_name, version, file_types
+
+        # Rewind and hand the already open file object to the parser,
+        # which streams it in chunks, instead of opening the file a
+        # second time by path
+        file.seek(0)
+
+        # Drop whitespace-only text nodes, comments and the parser's XML
+        # ID hash while parsing, since none of them are used here; the
+        # parser then allocates smaller nodes and fewer of them. Parsing
+        # is also defensive: entities are never resolved or fetched from
+        # the network, and malformed XML is recovered from rather than
+        # raised, so a broken file falls through to the validity check
+        # and gets skipped instead of aborting the whole merge
+        for _, element in etree.iterparse(
+            file, events=('end',), remove_blank_text=True,
+            remove_comments=True, collect_ids=False, resolve_entities=False,
+            no_network=True, huge_tree=False, recover=True
+        ):
+            if element.tag == TYPES_TAG:
+                # Recovered files can yield types with no name or empty
+                # members elements; drop those here so broken entries are
+                # skipped rather than crashing the aggregation later
+                mdt_name = element.findtext(NAME_TAG)
+                if mdt_name is not None:
+                    file_types.append((
+                        mdt_name,
+                        [
+                            member.text
+                            for member in element.iterfind(MEMBERS_TAG)
+                            if member.text is not None
+                        ]
+                    ))
+                # Free the types element and any already processed siblings
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif element.tag == VERSION_TAG:
+                version = element.text
+            elif element.tag == FULLNAME_TAG:
+                package_name = element.text
+
+    return package_name, version, file_types
+
+def build_package(types_dict, max_version, package_names):
+    '''
+    Yields the merged package XML as string blocks: a header, one types
+    block per metadata type, and a footer. Each types block is assembled
+    with a single join over a constant template, instead of element by
+    element, and types and members come out in alphabetical order
+    '''
 
-    for filepath in packages:
-        with open(filepath, 'r') as package: 
-            # Read the package.xml file and parse into a dict
-            xml_data = package.read()
-            package_dict = parse(xml_data)
+    yield PACKAGE_HEADER
 
-            # Check the xml file is a valid SFDC package, or skip it.
-            if 'Package' not in package_dict or\
-                'version' not in package_dict['Package'] or\
-                'types' not in package_dict['Package']:
+    for mdt_name in sorted(types_dict.keys()):
+        yield TYPE_TEMPLATE.format(
+            members='\n'.join(
+                MEMBER_TEMPLATE.format(escape(member))
+                for member in types_dict[mdt_name]
+            ),
+            name=escape(mdt_name)
+        )
 
-                if verbose:    
-                    print(f'{filepath} is not a valid SFDC package. Skipping.')
+    # Make the merged package's version the max found version, and include
+    # the used package names in its description
+    description = 'This package.xml was created by ' +\
+        'merging the following packages:\n' + '\n'.join(package_names)
+    yield PACKAGE_FOOTER.format(
+        version=max_version, description=escape(description)
+    )
 
-                break
+def write_package(file, types_dict, max_version, package_names):
+    '''
+    Streams the merged package as XML blocks to the given file object,
+    avoiding building the whole document in memory just to serialize it
+    afterwards
+    '''
 
-            if verbose: print(f'Processing {filepath}')
+    file.writelines(build_package(types_dict, max_version, package_names))
 
-            # Add the package name to the ones used for the merged file
-            package_names.append(package_dict['Package']['fullName'])
+def merge(packages, outpath, verbose, jobs):
+    '''
+    Takes all found package.xml files, streams each through lxml's iterparse
+    to extract its metadata types and members, and aggregates them in a
+    separate dict. Parsing is spread over up to JOBS worker processes when
+    there are enough files to merge. At the end, builds the merged SFDC
+    package from the aggregated metadata. The result is printed to STDOUT
+    or to a file in the OUTPUT directory
+    '''
+
+    if verbose: print('\n//// MERGING PACKAGES\n')
+
+    # Initialize the dict of member lists collected for each metadata type.
+    # Lists are kept as-is here and only turned into sets once all files are
+    # read, so each member is hashed once per file instead of once per update
+    member_lists = defaultdict(list)
+    package_names = [] # Initialize the list of package names
+    versions = [] # Initialize the list of package version numbers
+
+    # Parse the files over a process pool when there are enough of them for
+    # the speedup to outweigh the cost of starting worker processes,
+    # chunking the files so each worker gets a few per dispatch and the
+    # IPC overhead stays amortized
+    if len(packages) >= MIN_PARALLEL_PACKAGES and jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(
+                parse_package,
+                packages,
+                chunksize=max(1, len(packages) // (4 * jobs))
+            ))
+    else:
+        results = [parse_package(filepath) for filepath in packages]
+
+    for filepath, (package_name, version, file_types) in zip(
+        packages, results
+    ):
+        # Check the xml file is a valid SFDC package, or skip it.
+        if version is None or not file_types:
+            if verbose:
+                print(f'{filepath} is not a valid SFDC package. Skipping.')
+
+            continue
+
+        if verbose: print(f'Processing {filepath}')
+
+        # Add the package name to the ones used for the merged file
+        if package_name:
+            package_names.append(package_name)
+
+        # Collect the package version number
+        versions.append(float(version))
 
-            # Update the max package version number
-            if not max_version:
-                max_version = float(package_dict['Package']['version'])
-            max_version = max(
-                max_version, 
-                float(package_dict['Package']['version'])
+        # Collect this file's member list for each metadata type. The same
+        # type names and member strings recur across package files, so
+        # intern them: duplicates collapse to one canonical copy, whose
+        # cached hash makes the set unions below cheaper
+        for mdt_name, members in file_types:
+            member_lists[sys.intern(mdt_name)].append(
+                [sys.intern(member) for member in members]
             )
 
-            # Create the template from the first processed file
-            if not template:
-                template = package_dict
-            
-            # Get all the types tag, and make into list if there's only one
-            mdt_types = package_dict['Package']['types']
-            if type(mdt_types) == dict:
-                mdt_types = [mdt_types]
-
-            # Add the types to the dict if not there, then add members
-            for mdt_type in mdt_types:
-                if mdt_type['name'] not in types_dict.keys():
-                    types_dict[mdt_type['name']] = set()
-
-                members = mdt_type['members']
-                # If there's only one member, put it into list form
-                if type(members) == str:
-                    members = [members]
-                types_dict[mdt_type['name']].update(members)
+    # Union each type's member lists by chaining them into one constructor
+    # call, which sizes the underlying set once for all members instead of
+    # growing it union by union. SortedSet keeps members ordered on
+    # insertion, so writing them out later needs no per-type sort
+    types_dict = {
+        mdt_name: SortedSet(chain.from_iterable(lists))
+        for mdt_name, lists in member_lists.items()
+    }
+
+    # If every found file was skipped as invalid, there's nothing to merge
+    if not versions:
+        if verbose:
+            print('No valid SFDC packages found amongst the package.xml '\
+                + 'files. Nothing to merge.')
+        return
+
+    max_version = max(versions) # Take the max version number in one pass
 
     package_names.sort() # Sort the package names (not paths) alphabetically
-    # Replace the template's name
-    template['Package']['fullName'] = 'Merged_Package'
-    # Replace the temaplte's description, include used package names
-    template['Package']['description'] = 'This package.xml was created by ' +\
-        'merging the following packages:\n' + '\n'.join(package_names)
-    # Replace template's version by max version
-    template['Package']['version'] = f'{max_version:.1f}'
-    # Empty the template's types tags
-    template['Package']['types'] = []
-    # Get the metadata types names and order them alphabetically
-    ordered_names = list(types_dict.keys())
-    ordered_names.sort()
-
-    # Get the members of each metadata type, and add them to the package in
-    # alphabetical order, then add the name tag inside the types tag
-    for mdt_name in ordered_names:
-        members = list(types_dict[mdt_name])
-        members.sort()
-        template['Package']['types'].append(
-            {
-                'members': members,
-                'name': mdt_name
-            }
-        )
-    
+
     if verbose:
         print('\nMerging complete. package.xml created from packages:')
         print('\n'.join(package_names))
 
-    # If there's no -o flag, print the merged package to STDOUT, then return
+    # If there's no -o flag, print the merged package to STDOUT, then
+    # return. The XML bytes go straight to STDOUT's byte buffer, skipping
+    # the text layer's per-block encoding and letting consumers of a pipe
+    # start reading before the whole package is out
     if not outpath:
-        print('\n//// MERGED PACKAGE:\n')
-        print(
-            unparse(template, pretty=True)
+        print('\n//// MERGED PACKAGE:\n', flush=True)
+        writer = io.BufferedWriter(sys.stdout.buffer, buffer_size=1 << 20)
+        writer.writelines(
+            block.encode('utf-8')
+            for block in build_package(types_dict, max_version, package_names)
         )
+        writer.flush()
         return
-    
+
     # Write the merged package to the OUTPUT path
-    with open(outpath + '/package.xml', 'w') as file:
-        file.write(
-            unparse(template, pretty=True)
-        )
+    with open(outpath / 'package.xml', 'w') as file:
+        write_package(file, types_dict, max_version, package_names)
 
     if verbose: print(f'\npackage.xml written to {outpath}')
 
@@ -195,16 +342,10 @@ def main():
     # Validate that SOURCE and OUTPUT are actual directories
     sourcepath, outpath = validate_paths(args)
 
-    # Get all package.xml files in subdirectory tree with root at sourcepath
-    packages = [
-        os.path.join(dirpath, filename)
-        for dirpath, _, filenames in os.walk(sourcepath)
-        for filename in (
-            f for f in filenames if f == 'package.xml'
-        )
-    ]
-
-    if packages: packages.sort() # Sort package paths alphabetically
+    # Get all package.xml files in subdirectory tree with root at sourcepath.
+    # The paths are left unsorted: everything in the merged package is
+    # ordered by name or by content, never by source path
+    packages = list(find_packages(sourcepath))
 
     if args.verbose: # Inform found packages if verbose flag is on
         if not packages:
@@ -213,12 +354,13 @@ def main():
             return
         print('//// FOUND PACKAGES\n')
         print(f'{len(packages)} package files found:')
-        for package in packages:
+        for package in sorted(packages): # Sort only for display
             print(package)
 
     if not packages: return # If no package files found, exit
 
-    merge(packages, outpath, args.verbose) # Merge the found packages
+    # Merge the found packages
+    merge(packages, outpath, args.verbose, args.jobs)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file